@@ -8,12 +8,300 @@ import xml.dom.minidom
 import base64
 import mrdhelper
 import constants
+import json
+import fcntl
+import time
+import select
+import threading
+import collections
+import cProfile
+import pstats
+import tracemalloc
 from time import perf_counter
 
+# Optional : cap BLAS/OpenMP pools at runtime, when numpy is already loaded by the server
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
+
 
 # Folder for debug output files
 debugFolder = "/tmp/share/debug"
 
+# Folder for the lock files used to throttle concurrent process() calls
+slotFolder = "/tmp/openrecon-slots"
+
+# JSON UI, copied next to this module by build.py
+jsonUiPath = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.path.splitext(os.path.basename(__file__))[0] + "_json_ui.json")
+
+# Runtime resources, filled once by get_resources()
+resources = None
+
+# Buffers reused across series and connections (kept between exams), created once by get_arena()
+arena = None
+
+# Processing plans, by config/header fingerprint, filled by get_plan()
+plans     = collections.OrderedDict()
+plansLock = threading.Lock()
+plansMax  = 32
+
+def get_resources():
+    # Sized from the `reconstruction` block of the JSON UI, each value can be overridden by environment :
+    #   OPENRECON_CPU_CORES, OPENRECON_MEMORY_MB, OPENRECON_MAX_CONCURRENT
+    # BLAS/OpenMP threads are fixed by the OMP_NUM_THREADS... ENV written by build.py, before numpy is loaded :
+    # OPENRECON_CPU_CORES only changes them when threadpoolctl is installed, otherwise only the slot sizing.
+    # Max wait for a free processing slot, before failing the connection :
+    #   OPENRECON_SLOT_TIMEOUT_S
+    # Idle buffers kept by the BufferArena (default : 1/4 of the memory) :
+    #   OPENRECON_ARENA_MB
+    # Group flushing, not in the JSON UI (0 = disabled, since it splits the normalization of a series) :
+    #   OPENRECON_MAX_GROUP_IMAGES, OPENRECON_IDLE_TIMEOUT_S
+    global resources
+    if resources is not None:
+        return resources
+
+    reconstruction = {}
+    if os.path.exists(jsonUiPath):
+        try:
+            with open(jsonUiPath, 'r') as fid:
+                reconstruction = json.load(fid).get('reconstruction', {})
+        except:
+            logging.warning("Failed to read JSON UI %s, using default resources", jsonUiPath)
+    else:
+        logging.warning("JSON UI %s NOT FOUND, using default resources", jsonUiPath)
+
+    cpu_cores = int(os.environ.get('OPENRECON_CPU_CORES', reconstruction.get('min_count_required_cpu_cores', 1)))
+    memory_mb = int(os.environ.get('OPENRECON_MEMORY_MB', reconstruction.get('min_required_memory'         , 4096)))
+    cpu_cores = max(cpu_cores, 1)
+    memory_mb = max(memory_mb, 1)
+
+    # How many connections fit in the container, each one using the declared envelope
+    host_cores, host_memory_mb = get_container_limits()
+    max_concurrent = max(min(host_cores // cpu_cores, host_memory_mb // memory_mb), 1)
+    max_concurrent = int(os.environ.get('OPENRECON_MAX_CONCURRENT', max_concurrent))
+
+    resources = {
+        'cpu_cores'       : cpu_cores,
+        'memory_mb'       : memory_mb,
+        'max_concurrent'  : max(max_concurrent, 1),
+        'slot_timeout_s'  : float(os.environ.get('OPENRECON_SLOT_TIMEOUT_S', 600)),
+        'can_use_gpu'     : bool(reconstruction.get('can_use_gpu', False)),
+        'max_group_images': int  (os.environ.get('OPENRECON_MAX_GROUP_IMAGES', 0)),
+        'idle_timeout_s'  : float(os.environ.get('OPENRECON_IDLE_TIMEOUT_S'  , 0)),
+        'arena_mb'        : int  (os.environ.get('OPENRECON_ARENA_MB', memory_mb // 4)),
+    }
+    logging.info("Runtime resources : %s", resources)
+
+    return resources
+
+def get_container_limits():
+    # Host values, reduced by the cgroup (v2) limits of the container when they are set
+    cores     = len(os.sched_getaffinity(0))
+    memory_mb = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // 2**20
+
+    try:
+        with open('/sys/fs/cgroup/cpu.max', 'r') as fid:
+            quota, period = fid.read().split()
+        if quota != 'max':
+            cores = min(cores, max(int(int(quota) / int(period)), 1))
+    except (OSError, ValueError):
+        pass
+
+    try:
+        with open('/sys/fs/cgroup/memory.max', 'r') as fid:
+            limit = fid.read().strip()
+        if limit != 'max':
+            memory_mb = min(memory_mb, int(limit) // 2**20)
+    except (OSError, ValueError):
+        pass
+
+    return cores, memory_mb
+
+class BufferArena:
+    # Pool of idle numpy buffers keyed by (shape, dtype), least recently used evicted first.
+    # lease() returns an uninitialized array, release() gives it back for the next group.
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.buffers   = collections.OrderedDict()
+        self.nbytes    = 0
+        self.hits      = 0
+        self.misses    = 0
+        self.evictions = 0
+        self.lock      = threading.Lock()
+
+    def lease(self, shape, dtype):
+        key = (tuple(shape), np.dtype(dtype).str)
+        with self.lock:
+            if key in self.buffers:
+                buf = self.buffers[key].pop()
+                if len(self.buffers[key]) == 0:
+                    del self.buffers[key]
+                self.nbytes -= buf.nbytes
+                self.hits   += 1
+                return buf
+            self.misses += 1
+        return np.empty(shape, dtype=dtype)
+
+    def release(self, buf):
+        if buf.nbytes > self.max_bytes:
+            return
+        key = (buf.shape, buf.dtype.str)
+        with self.lock:
+            self.buffers.setdefault(key, []).append(buf)
+            self.buffers.move_to_end(key)
+            self.nbytes += buf.nbytes
+            while self.nbytes > self.max_bytes:
+                oldKey = next(iter(self.buffers))
+                old = self.buffers[oldKey].pop(0)
+                if len(self.buffers[oldKey]) == 0:
+                    del self.buffers[oldKey]
+                self.nbytes    -= old.nbytes
+                self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'idle_mb': self.nbytes / 2**20}
+
+def get_arena():
+    global arena
+    if arena is None:
+        arena = BufferArena(get_resources()['arena_mb'] * 2**20)
+    return arena
+
+def wait_for_message(connection, timeout):
+    # True when the next message can be read, False after timeout seconds without data.
+    # Waiting here, instead of in a blocking next(), leaves the connection lock free for sending.
+    if (timeout is None) or (getattr(connection, 'socket', None) is None):
+        return True
+    readable, _, _ = select.select([connection.socket], [], [], timeout)
+    return len(readable) > 0
+
+def is_series_end(image):
+    # Cheap check first : most images do not carry an ICE MiniHeader
+    if 'IceMiniHead' not in image.attribute_string:
+        return False
+    meta = ismrmrd.Meta.deserialize(image.attribute_string)
+    if mrdhelper.get_meta_value(meta, 'IceMiniHead') is None:
+        return False
+    return mrdhelper.extract_minihead_bool_param(base64.b64decode(meta['IceMiniHead']).decode('utf-8'), 'BIsSeriesEnd') is True
+
+def acquire_slot(max_concurrent, timeout):
+    # One lock file per slot : flock() works across the server threads and processes
+    if not os.path.exists(slotFolder):
+        os.makedirs(slotFolder, exist_ok=True)
+
+    deadline = time.time() + timeout
+    waited = False
+    while True:
+        for iSlot in range(max_concurrent):
+            fid = open(os.path.join(slotFolder, "slot%d.lock" % iSlot), 'w')
+            try:
+                fcntl.flock(fid, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                logging.info("Acquired processing slot %d/%d", iSlot+1, max_concurrent)
+                return fid
+            except BlockingIOError:
+                fid.close()
+        if time.time() > deadline:
+            raise Exception("No free processing slot after %.0f s (%d busy)" % (timeout, max_concurrent))
+        if not waited:
+            logging.info("All %d processing slots busy, waiting...", max_concurrent)
+            waited = True
+        time.sleep(0.1)
+
+def release_slot(fid):
+    fcntl.flock(fid, fcntl.LOCK_UN)
+    fid.close()
+
+def get_param_profiling(config):
+    # Not declared in the JSON UI on purpose : set it in the client config, or use OPENRECON_PROFILING=1
+    if os.environ.get('OPENRECON_PROFILING', '').lower() in ['1', 'true']:
+        return True
+    if ('parameters' in config) and ('Profiling' in config['parameters']):
+        if type(config['parameters']['Profiling']) is str:
+            return config['parameters']['Profiling'].lower() == 'true'
+        elif type(config['parameters']['Profiling']) is bool:
+            return config['parameters']['Profiling']
+    return False
+
+def start_profiling(config):
+    # Returns None when profiling is disabled, so all profiling calls are no-op
+    if not get_param_profiling(config):
+        return None
+
+    logging.info("Profiling enabled for this connection")
+    prof = {
+        'series'   : None,
+        'timestamp': time.strftime('%Y%m%d-%H%M%S'),
+        'stages'   : [],
+        'profile'  : cProfile.Profile(),
+        # tracemalloc is global to the process : only the connection that started it stops it
+        'tracemalloc_owner': not tracemalloc.is_tracing(),
+    }
+    if prof['tracemalloc_owner']:
+        tracemalloc.start()
+    try:
+        prof['profile'].enable()
+    except ValueError:
+        # another connection of this process is already profiled
+        logging.warning("cProfile not available for this connection : %s", traceback.format_exc())
+        prof['profile'] = None
+    return prof
+
+def profile_stage(prof, name, series=None):
+    # Record current/peak traced memory since the previous stage
+    if prof is None:
+        return
+    if prof['series'] is None:
+        prof['series'] = series
+    if not tracemalloc.is_tracing():
+        return
+    # (peaks are shared with other profiled connections running in this process)
+    current, peak = tracemalloc.get_traced_memory()
+    prof['stages'].append((name, series, current, peak))
+    tracemalloc.reset_peak()
+
+def stop_profiling(prof):
+    if prof is None:
+        return
+
+    try:
+        if prof['profile'] is not None:
+            prof['profile'].disable()
+        profile_stage(prof, 'end')
+        snapshot = tracemalloc.take_snapshot() if tracemalloc.is_tracing() else None
+        if prof['tracemalloc_owner']:
+            tracemalloc.stop()
+
+        if not os.path.exists(debugFolder):
+            os.makedirs(debugFolder)
+        basePath = os.path.join(debugFolder, "profile_series%s_%s" % (prof['series'], prof['timestamp']))
+
+        # Binary cProfile output, e.g. for snakeviz
+        if prof['profile'] is not None:
+            prof['profile'].dump_stats(basePath + ".prof")
+
+        with open(basePath + ".txt", 'w') as fid:
+            fid.write("# tracemalloc : traced memory per stage (MiB)\n")
+            for (name, series, current, peak) in prof['stages']:
+                fid.write("%-20s series=%-6s current=%10.3f peak=%10.3f\n" % (name, series, current/2**20, peak/2**20))
+            if len(prof['stages']) > 0:
+                fid.write("overall peak = %.3f MiB\n" % (max([stage[3] for stage in prof['stages']])/2**20))
+
+            if snapshot is not None:
+                fid.write("\n# tracemalloc : top allocations still alive at the end\n")
+                for stat in snapshot.statistics('lineno')[:20]:
+                    fid.write("%s\n" % stat)
+
+            if prof['profile'] is not None:
+                fid.write("\n# cProfile : top functions by cumulative time\n")
+                pstats.Stats(prof['profile'], stream=fid).sort_stats('cumulative').print_stats(30)
+
+        logging.info("Profiling written to %s.prof/.txt", basePath)
+    except:
+        logging.error("Failed to write profiling output : %s", traceback.format_exc())
+
 def process(connection, config, metadata):
     logging.info("Config: \n%s", config)
 
@@ -33,11 +321,41 @@ def process(connection, config, metadata):
     except:
         logging.info("Improperly formatted metadata: \n%s", metadata)
 
+    slot = None
+    prof = None
+
     # Continuously parse incoming data parsed from MRD messages
     currentSeries = 0
     imgGroup = []
     try:
-        for item in connection:
+        # Stay inside the envelope declared in the JSON UI
+        res = get_resources()
+        if threadpool_limits is not None:
+            threadpool_limits(limits=res['cpu_cores'])
+        else:
+            logging.debug("threadpoolctl not installed : BLAS/OpenMP threads as set by OMP_NUM_THREADS... at startup")
+        idleTimeout = res['idle_timeout_s'] if res['idle_timeout_s'] > 0 else None
+
+        slot = acquire_slot(res['max_concurrent'], res['slot_timeout_s'])
+        prof = start_profiling(config)
+
+        plan = get_plan(config, metadata)
+
+        items = iter(connection)
+        while True:
+            if not wait_for_message(connection, idleTimeout):
+                if len(imgGroup) > 0:
+                    logging.info("Processing a group of images because no image was received for %.1f s", idleTimeout)
+                    image = process_image(imgGroup, connection, config, metadata, plan, prof)
+                    connection.send_image(image)
+                    imgGroup = []
+                continue
+
+            try:
+                item = next(items)
+            except StopIteration:
+                break
+
             # ----------------------------------------------------------
             # Raw k-space data messages
             # ----------------------------------------------------------
@@ -54,13 +372,30 @@ def process(connection, config, metadata):
                 if item.image_series_index != currentSeries:
                     logging.info("Processing a group of images because series index changed to %d", item.image_series_index)
                     currentSeries = item.image_series_index
-                    image = process_image(imgGroup, connection, config, metadata)
+                    image = process_image(imgGroup, connection, config, metadata, plan, prof)
                     connection.send_image(image)
                     imgGroup = []
 
                 # Only process magnitude images -- send phase images back without modification (fallback for images with unknown type)
                 if (item.image_type is ismrmrd.IMTYPE_MAGNITUDE) or (item.image_type == 0):
+                    # Originals are not modified : forward them right away, without copy,
+                    # the inverted images will follow once the group is processed
+                    if plan['saveoriginalimages']:
+                        connection.send_image(item)
                     imgGroup.append(item)
+
+                    # Do not wait for the next series : the scanner flags the last image (i.e. follow ICE logic for splitting series)
+                    if is_series_end(item):
+                        logging.info("Processing a group of images because BIsSeriesEnd is set")
+                        image = process_image(imgGroup, connection, config, metadata, plan, prof)
+                        connection.send_image(image)
+                        imgGroup = []
+
+                    elif (res['max_group_images'] > 0) and (len(imgGroup) >= res['max_group_images']):
+                        logging.info("Processing a group of images because %d images were accumulated", len(imgGroup))
+                        image = process_image(imgGroup, connection, config, metadata, plan, prof)
+                        connection.send_image(image)
+                        imgGroup = []
                 else:
                     tmpMeta = ismrmrd.Meta.deserialize(item.attribute_string)
                     tmpMeta['Keep_image_geometry']    = 1
@@ -81,7 +416,7 @@ def process(connection, config, metadata):
         # image in a series is typically not separately flagged.
         if len(imgGroup) > 0:
             logging.info("Processing a group of images (untriggered)")
-            image = process_image(imgGroup, connection, config, metadata)
+            image = process_image(imgGroup, connection, config, metadata, plan, prof)
             connection.send_image(image)
             imgGroup = []
 
@@ -93,23 +428,21 @@ def process(connection, config, metadata):
         connection.shutdown_close()
 
     finally:
+        if slot is not None:
+            release_slot(slot)
         try:
             connection.send_close()
         except:
             logging.error("Failed to send close message!")
 
-def process_image(images, connection, config, metadata):
-    
-    if len(images) == 0:
-        return []
-
-    # Create folder, if necessary
-    if not os.path.exists(debugFolder):
-        os.makedirs(debugFolder)
-        logging.debug("Created folder " + debugFolder + " for debug output files")
-
-    logging.debug("Processing data with %d images of type %s", len(images), ismrmrd.get_dtype_from_data_type(images[0].data_type))
+        # Diagnostics last : they must not prevent the close above
+        stop_profiling(prof)
+        try:
+            logging.info("Buffer arena : %s", get_arena().stats())
+        except:
+            logging.error("Failed to get buffer arena stats!")
 
+def get_param_saveoriginalimages(config):
     param_saveoriginalimages = False
     if ('parameters' in config) and ('SaveOriginalImages' in config['parameters']):
         logging.debug(f"type of config['parameters']['SaveOriginalImages'] is {type(config['parameters']['SaveOriginalImages'])}")
@@ -127,13 +460,80 @@ def process_image(images, connection, config, metadata):
         logging.warning("config['parameters']['SaveOriginalImages'] NOT FOUND !!")
     logging.debug(f'param_saveoriginalimages = {param_saveoriginalimages}')
 
-    if param_saveoriginalimages:
-        images_ORIG = images.copy()
+    return param_saveoriginalimages
+
+def get_plan(config, metadata):
+    # Everything that only depends on the connection, computed once and shared by
+    # all connections of the server process with the same config and header values
+    BitsStored = 12
+    if (mrdhelper.get_userParameterLong_value(metadata, "BitsStored") is not None):
+        BitsStored = mrdhelper.get_userParameterLong_value(metadata, "BitsStored")
+
+    # Create folder, if necessary (not cached : it may be removed between connections)
+    if not os.path.exists(debugFolder):
+        os.makedirs(debugFolder, exist_ok=True)
+        logging.debug("Created folder " + debugFolder + " for debug output files")
+
+    fingerprint = (json.dumps(config, sort_keys=True, default=str), BitsStored)
+    with plansLock:
+        if fingerprint in plans:
+            plans.move_to_end(fingerprint)
+            logging.debug("Using cached processing plan")
+            return plans[fingerprint]
+
+    # Determine max value (12 or 16 bit)
+    maxVal = 2**BitsStored - 1
+
+    plan = {
+        'saveoriginalimages': get_param_saveoriginalimages(config),
+        'bits_stored'       : BitsStored,
+        'max_val'           : maxVal,
+        # MetaAttributes identical for all output images
+        'meta': {
+            'DataRole'                     : 'Image',
+            'ImageProcessingHistory'       : ['PYTHON', 'INVERT'],
+            'WindowCenter'                 : str((maxVal+1)/2),
+            'WindowWidth'                  : str((maxVal+1)),
+            'SequenceDescriptionAdditional': 'OPENRECON_invertcontrast',
+            'Keep_image_geometry'          : 1,
+        },
+    }
+    logging.info("Processing plan : %s", plan)
+
+    with plansLock:
+        plans[fingerprint] = plan
+        while len(plans) > plansMax:
+            plans.popitem(last=False)
+    return plan
+
+def process_image(images, connection, config, metadata, plan=None, prof=None):
+    
+    if len(images) == 0:
+        return []
+
+    if plan is None:
+        plan = get_plan(config, metadata)
+
+    series = images[0].image_series_index
+    profile_stage(prof, 'start', series)
+
+    logging.debug("Processing data with %d images of type %s", len(images), ismrmrd.get_dtype_from_data_type(images[0].data_type))
 
     # Note: The MRD Image class stores data as [cha z y x]
 
+    # Working buffers are leased from the arena and given back once the output images are created
+    buffers = get_arena()
+
     # Extract image data into a 5D array of size [img cha z y x]
-    data = np.stack([img.data                              for img in images])
+    # (np.stack raises on mismatched shapes and promotes mixed dtypes : keep it for such groups)
+    leased = all((img.data.shape == images[0].data.shape) and (img.data.dtype == images[0].data.dtype) for img in images)
+    if leased:
+        stacked = buffers.lease((len(images),) + images[0].data.shape, images[0].data.dtype)
+        for iImg in range(len(images)):
+            stacked[iImg] = images[iImg].data
+    else:
+        stacked = np.stack([img.data for img in images])
+    data = stacked
     head = [img.getHead()                                  for img in images]
     meta = [ismrmrd.Meta.deserialize(img.attribute_string) for img in images]
 
@@ -149,25 +549,31 @@ def process_image(images, connection, config, metadata):
 
     logging.debug("Original image data is size %s" % (data.shape,))
     np.save(debugFolder + "/" + "imgOrig.npy", data)
+    profile_stage(prof, 'stack', series)
 
-    # Determine max value (12 or 16 bit)
-    BitsStored = 12
-    if (mrdhelper.get_userParameterLong_value(metadata, "BitsStored") is not None):
-        BitsStored = mrdhelper.get_userParameterLong_value(metadata, "BitsStored")
-    maxVal = 2**BitsStored - 1
+    # Max value (12 or 16 bit), from the plan
+    maxVal = plan['max_val']
 
     # Normalize and convert to int16
-    data = data.astype(np.float64)
-    data *= maxVal/data.max()
-    data = np.around(data)
-    data = data.astype(np.int16)
+    # (work on the [img cha z y x] buffers, through the same [y x z cha img] view)
+    work = buffers.lease(stacked.shape, np.float64)
+    np.copyto(work, stacked, casting='unsafe')
+    work *= maxVal/work.max()
+    np.around(work, out=work)
+    inverted = buffers.lease(stacked.shape, np.int16)
+    np.copyto(inverted, work, casting='unsafe')
+    data = inverted.transpose((3, 4, 2, 1, 0))
 
     # Invert image contrast
-    data = maxVal-data
-    data = np.abs(data)
+    if maxVal <= np.iinfo(np.int16).max:
+        np.subtract(maxVal, inverted, out=inverted)
+        np.abs(inverted, out=inverted)
+    else:
+        # maxVal does not fit in int16 : keep numpy type promotion
+        data = maxVal-data
+        data = np.abs(data)
     np.save(debugFolder + "/" + "imgInverted.npy", data)
-
-    currentSeries = 0
+    profile_stage(prof, 'normalize+invert', series)
 
     # Re-slice back into 2D images
     imagesOut = [None] * data.shape[-1]
@@ -187,14 +593,9 @@ def process_image(images, connection, config, metadata):
         if (imagesOut[iImg].data_type == ismrmrd.DATATYPE_CXFLOAT) or (imagesOut[iImg].data_type == ismrmrd.DATATYPE_CXDOUBLE):
             oldHeader.image_type = ismrmrd.IMTYPE_COMPLEX
 
-        # Increment series number when flag detected (i.e. follow ICE logic for splitting series)
-        if mrdhelper.get_meta_value(meta[iImg], 'IceMiniHead') is not None:
-            if mrdhelper.extract_minihead_bool_param(base64.b64decode(meta[iImg]['IceMiniHead']).decode('utf-8'), 'BIsSeriesEnd') is True:
-                currentSeries += 1
-
-        if param_saveoriginalimages:
+        if plan['saveoriginalimages']:
             oldHeader.image_series_index += 1
-        logging.debug(f'param_saveoriginalimages = {param_saveoriginalimages    }')
+        logging.debug(f'saveoriginalimages       = {plan["saveoriginalimages"]}')
         logging.debug(f'image_series_index       = {oldHeader.image_series_index}')
         logging.debug(f'image_index              = {oldHeader.image_index       }')
         logging.debug(f'slice                    = {oldHeader.slice             }')
@@ -203,12 +604,8 @@ def process_image(images, connection, config, metadata):
 
         # Create a copy of the original ISMRMRD Meta attributes and update
         tmpMeta = meta[iImg]
-        tmpMeta['DataRole']                       = 'Image'
-        tmpMeta['ImageProcessingHistory']         = ['PYTHON', 'INVERT']
-        tmpMeta['WindowCenter']                   = str((maxVal+1)/2)
-        tmpMeta['WindowWidth']                    = str((maxVal+1))
-        tmpMeta['SequenceDescriptionAdditional']  = 'OPENRECON_invertcontrast'
-        tmpMeta['Keep_image_geometry']            = 1
+        for key in plan['meta']:
+            tmpMeta[key] = plan['meta'][key]
 
         # Add image orientation directions to MetaAttributes if not already present
         if tmpMeta.get('ImageRowDir') is None:
@@ -223,7 +620,12 @@ def process_image(images, connection, config, metadata):
 
         imagesOut[iImg].attribute_string = metaXml
 
-    if param_saveoriginalimages:
-        return images_ORIG + imagesOut
-    else:
-        return               imagesOut
+    # from_array() copied the data : buffers can be reused by the next group
+    if leased:
+        buffers.release(stacked)
+    buffers.release(work)
+    buffers.release(inverted)
+    profile_stage(prof, 'reslice', series)
+
+    # Originals (if requested) were already sent by process(), as soon as received
+    return imagesOut
@@ -0,0 +1,235 @@
+# intenend for python3
+
+# Synthetic image workload for an OpenRecon app module.
+# Run by `build.py --perf-gate` inside the freshly built container, but it also works
+# locally, next to `python-ismrmrd-server` (see --server-dir).
+
+# builtin modules
+import argparse
+import importlib
+import json
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+import tracemalloc
+
+
+class SyntheticConnection:
+    # Minimal stand-in for the python-ismrmrd-server Connection : feeds images, counts what is sent back
+
+    def __init__(self, images: list) -> None:
+        self.images = images
+        self.sent   = 0
+
+    def __iter__(self):
+        return iter(self.images)
+
+    def send_image(self, image) -> None:
+        if isinstance(image, list):
+            self.sent += len(image)
+        else:
+            self.sent += 1
+
+    def send_logging(self, level, contents) -> None:
+        logging.getLogger().error(contents)
+
+    def send_close(self) -> None:
+        pass
+
+    def shutdown_close(self) -> None:
+        raise RuntimeError('the app module signaled a failure, see log above')
+
+
+def make_workload(n_series: int, n_images: int, matrix: int) -> list:
+    import ismrmrd
+    import numpy as np
+
+    # Deterministic content, so all builds are compared on the same data
+    rng = np.random.default_rng(0)
+    images = []
+    for iSeries in range(n_series):
+        for iImg in range(n_images):
+            data = rng.integers(0, 4096, size=(1, 1, matrix, matrix), dtype=np.uint16)
+            image = ismrmrd.Image.from_array(data, transpose=False)
+            image.image_type         = ismrmrd.IMTYPE_MAGNITUDE
+            image.image_series_index = iSeries + 1
+            image.image_index        = iImg
+            image.slice              = iImg
+            meta = ismrmrd.Meta()
+            meta['DataRole'] = 'Image'
+            image.attribute_string = meta.serialize()
+            images.append(image)
+    return images
+
+
+def make_header(bits_stored: int = 12):
+    import ismrmrd
+
+    # Minimal MRD header : what server.py logs when parsing it, and what the app reads
+    header = ismrmrd.xsd.ismrmrdHeader()
+    header.acquisitionSystemInformation = ismrmrd.xsd.acquisitionSystemInformationType()
+    header.acquisitionSystemInformation.systemVendor          = 'benchmark'
+    header.acquisitionSystemInformation.systemModel           = 'synthetic'
+    header.acquisitionSystemInformation.systemFieldStrength_T = 3.0
+    header.experimentalConditions = ismrmrd.xsd.experimentalConditionsType()
+    header.experimentalConditions.H1resonanceFrequency_Hz = 123200000
+    header.userParameters = ismrmrd.xsd.userParametersType()
+    bits = ismrmrd.xsd.userParameterLongType()
+    bits.name  = 'BitsStored'
+    bits.value = bits_stored
+    header.userParameters.userParameterLong.append(bits)
+    return header
+
+
+def run(module, images: list, config: dict, metadata) -> int:
+    connection = SyntheticConnection(images)
+    module.process(connection, config, metadata)
+    return connection.sent
+
+
+def run_session(sock: socket.socket, config, images: list, header, timeout: float = 60) -> int:
+    # One MRD session over a connected socket, in the order the scanner sends it :
+    # config name, JSON config text (for a dict config), XML header, images, close.
+    # Returns the number of images sent back.
+    import ismrmrd
+    import connection
+
+    errors = []
+
+    def send() -> None:
+        try:
+            sender = connection.Connection(sock, False, "", "", "dataset")
+            if isinstance(config, dict):
+                sender.send_config_file(config['parameters']['config'])
+                sender.send_text(json.dumps(config))
+            else:
+                sender.send_config_file(config)
+            sender.send_metadata(ismrmrd.xsd.ToXML(header))
+            for image in images:
+                sender.send_image(image)
+            sender.send_close()
+        except Exception as e:
+            errors.append(e)
+
+    # send from a thread : the server sends images back while it still receives
+    sock.settimeout(timeout)
+    sender = threading.Thread(target=send)
+    sender.start()
+    received = 0
+    for item in connection.Connection(sock, False, "", "", "dataset"):
+        if isinstance(item, ismrmrd.Image):
+            received += 1
+    sender.join()
+    if errors:
+        raise errors[0]
+    return received
+
+
+def local_session(config, images: list, header) -> int:
+    # Serve the session with server.Server.handle() of python-ismrmrd-server, in this process
+    import server
+
+    client_sock, server_sock = socket.socketpair()
+    handler = threading.Thread(target=server.Server('127.0.0.1', 0, 'invertcontrast', False, '', False).handle, args=(server_sock,))
+    handler.start()
+    try:
+        return run_session(client_sock, config, images, header)
+    finally:
+        client_sock.close()
+        handler.join()
+
+
+def run_sessions(module_name: str, address: str | None = None) -> dict:
+    # Smoke test : one session with the app config, one with the `invertcontrast` config of the server,
+    # served in this process, or by a running server at `host:port`
+    header  = make_header()
+    results = {}
+    for config in [{'parameters': {'config': module_name, 'SaveOriginalImages': True}}, 'invertcontrast']:
+        images = make_workload(n_series=2, n_images=2, matrix=32)
+        if address is None:
+            received = local_session(config, images, header)
+        else:
+            host, port = address.rsplit(':', 1)
+            with socket.create_connection((host, int(port)), timeout=10) as sock:
+                received = run_session(sock, config, images, header)
+        name = config if isinstance(config, str) else module_name
+        if received < len(images):
+            raise RuntimeError(f'config `{name}` sent back {received} images for {len(images)} sent')
+        results[name] = received
+    return results
+
+
+def main(args: argparse.Namespace):
+
+    logging.basicConfig(
+        level=logging.WARNING,
+        format=f"%(levelname)8s:%(funcName)15s: %(message)s",
+    )
+
+    sys.path.insert(0, args.server_dir)
+
+    if args.session:
+        # last line of stdout is the result, parsed by build.py
+        print(json.dumps({'sessions': run_sessions(args.module, args.address)}))
+        return
+
+    module = importlib.import_module(args.module)
+
+    config   = {'parameters': {'config': args.module, 'SaveOriginalImages': args.save_original_images}}
+    metadata = make_header()
+    n_images = args.series * args.images
+
+    # peak memory : first, while the module state (e.g. its buffer arena) is still empty,
+    # so that all working buffers are allocated under tracemalloc
+    images = make_workload(args.series, args.images, args.matrix)
+    tracemalloc.start()
+    run(module, images, config, metadata)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    # throughput : best of N, on a fresh copy of the workload each time
+    best = None
+    for _ in range(args.repeat):
+        images = make_workload(args.series, args.images, args.matrix)
+        start = time.perf_counter()
+        run(module, images, config, metadata)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    result = {
+        'workload': {
+            'series'              : args.series,
+            'images'              : args.images,
+            'matrix'              : args.matrix,
+            'save_original_images': args.save_original_images,
+        },
+        'images_per_s'  : n_images / best,
+        'peak_memory_mb': peak / 2**20,
+    }
+    # last line of stdout is the result, parsed by build.py
+    print(json.dumps(result))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        prog            = 'benchmark',
+        description     = 'Run a synthetic image workload through an OpenRecon app module',
+        formatter_class = argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument('--module'    , required=True, help='Name of the .py process module, ex: `i2i-save-original-images`')
+    parser.add_argument('--server-dir', default=os.path.join(os.getcwd(), 'python-ismrmrd-server'), help='Directory containing the module, `mrdhelper` and `constants`')
+    parser.add_argument('--series'    , type=int, default=4  , help='Number of series')
+    parser.add_argument('--images'    , type=int, default=64 , help='Number of images per series')
+    parser.add_argument('--matrix'    , type=int, default=256, help='Image matrix size')
+    parser.add_argument('--repeat'    , type=int, default=3  , help='Number of timed runs, the best one is kept')
+    parser.add_argument('--save-original-images', action='store_true', help='Enable the `SaveOriginalImages` parameter')
+    parser.add_argument('--session'   , action='store_true', help='Instead of timing : smoke test with real MRD sessions (app config and `invertcontrast`)')
+    parser.add_argument('--address'   , default=None, help='With --session : `host:port` of a running server, instead of serving the sessions in this process')
+
+    args = parser.parse_args()
+
+    main(args)
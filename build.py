@@ -16,6 +16,7 @@ import re
 import datetime
 import json
 import base64
+import time
 
 
 def print_section(name: str) -> None:
@@ -164,6 +165,174 @@ def check_target_dir(target_path: str) -> dict:
     return target_data
         
 
+def run_benchmark(image_name: str, module_name: str, benchmark_path: str, options: list[str] | None = None) -> dict:
+    logger = logging.getLogger()
+
+    # run the synthetic workload inside the freshly built image, offline
+    logger.info(f'running `{os.path.basename(benchmark_path)}` in image `{image_name}`')
+    result = subprocess.run([
+        'docker', 'run', '--rm', '--network', 'none',
+        '--volume', f'{benchmark_path}:/opt/bench/benchmark.py:ro',
+        '--workdir', '/opt/code/python-ismrmrd-server',
+        '--entrypoint', 'python3',
+        image_name,
+        '/opt/bench/benchmark.py', f'--module={module_name}', '--server-dir=/opt/code/python-ismrmrd-server',
+        ] + (options or []), stdout=subprocess.PIPE, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def check_performance(image_name: str, module_name: str, benchmark_path: str, baseline_path: str, tolerance: float, update_baseline: bool) -> None:
+    logger = logging.getLogger()
+
+    measured = run_benchmark(image_name, module_name, benchmark_path)
+    logger.info(f"measured : {measured['images_per_s']:.1f} images/s, peak memory {measured['peak_memory_mb']:.1f} MB")
+
+    if update_baseline:
+        with open(baseline_path, 'w') as fid:
+            json.dump(measured, fid, indent=2)
+        logger.info(f'baseline updated : {baseline_path}')
+        return
+
+    # (reached with `--perf-gate` only : `--perf-update-baseline` writes the baseline above)
+    if not os.path.exists(baseline_path):
+        logger.critical(f'no baseline found, performance cannot be checked : {baseline_path}')
+        logger.critical('run once with `--perf-update-baseline` and commit the file')
+        sys.exit(1)
+
+    with open(baseline_path, 'r') as fid:
+        baseline = json.load(fid)
+    logger.info(f"baseline : {baseline['images_per_s']:.1f} images/s, peak memory {baseline['peak_memory_mb']:.1f} MB")
+
+    if measured['workload'] != baseline['workload']:
+        logger.critical(f"workload differs from the baseline one : {measured['workload']} != {baseline['workload']}")
+        sys.exit(1)
+
+    regressions = []
+    if measured['images_per_s'] < baseline['images_per_s'] * (1 - tolerance):
+        regressions.append(f"throughput {measured['images_per_s']:.1f} < {baseline['images_per_s']:.1f} images/s")
+    if measured['peak_memory_mb'] > baseline['peak_memory_mb'] * (1 + tolerance):
+        regressions.append(f"peak memory {measured['peak_memory_mb']:.1f} > {baseline['peak_memory_mb']:.1f} MB")
+    if regressions:
+        for regression in regressions:
+            logger.critical(f'performance regression beyond {tolerance:.0%} : {regression}')
+        sys.exit(1)
+    logger.info(f'performance within {tolerance:.0%} of the baseline')
+
+
+def run_dev_server(target_data: dict, target_path: str, debug_path: str, port: int) -> None:
+    logger = logging.getLogger()
+
+    # the `python-ismrmrd-server` base image, with the app dir bind-mounted : no Dockerfile, tar, PDF or zip
+    container_name = f"openrecon-dev-{target_data['name']['process']}".lower()
+    with open(target_data['path']['ui_json'], 'r') as fid:
+        cpu_cores = json.load(fid)['reconstruction'].get('min_count_required_cpu_cores', 1)
+    subprocess.run(['docker', 'rm', '--force', container_name], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    os.makedirs(debug_path, exist_ok=True)
+    logger.info(f'starting container `{container_name}` on port {port}, app dir mounted from {target_path}')
+    subprocess.run([
+        'docker', 'run', '--detach',
+        '--name'   , container_name,
+        '--publish', f'{port}:9002',
+        '--volume' , f'{target_path}:/opt/app:ro',
+        '--volume' , f'{debug_path}:/tmp/share/debug',
+        '--env'    , 'PYTHONPATH=/opt/app',
+        # same thread cap as the built image
+        '--env'    , f'OMP_NUM_THREADS={cpu_cores}',
+        '--env'    , f'OPENBLAS_NUM_THREADS={cpu_cores}',
+        '--env'    , f'MKL_NUM_THREADS={cpu_cores}',
+        '--env'    , f'NUMEXPR_NUM_THREADS={cpu_cores}',
+        'python-ismrmrd-server',
+        'python3', '/opt/code/python-ismrmrd-server/main.py', '-v', '-H=0.0.0.0', '-p=9002', '-l=/tmp/python-ismrmrd-server.log', f"--defaultConfig={target_data['name']['process']}",
+        ], check=True)
+
+    def snapshot() -> dict:
+        return {path: os.path.getmtime(path) for path in glob.glob(os.path.join(target_path, '*')) if os.path.isfile(path)}
+
+    def follow_logs(since: float) -> subprocess.Popen:
+        return subprocess.Popen(['docker', 'logs', '--follow', '--since', f'{since:.3f}', container_name])
+
+    # the server imports the module once : restart it when any app file changes
+    mtimes = snapshot()
+    logs   = follow_logs(since=time.time()-60)
+    logger.info('watching the app dir for changes, CTRL+C to stop')
+    try:
+        while True:
+            time.sleep(0.5)
+            current = snapshot()
+            if current == mtimes:
+                continue
+            changed = [os.path.basename(path) for path in current if current[path] != mtimes.get(path)]
+            mtimes = current
+            logger.info(f'change detected in {changed}, restarting server...')
+            logs.terminate()
+            since = time.time()
+            subprocess.run(['docker', 'restart', '--time', '0', container_name], stdout=subprocess.DEVNULL, check=True)
+            logs = follow_logs(since=since)
+            logger.info('server restarted')
+    except KeyboardInterrupt:
+        logger.info('stopping dev server')
+    finally:
+        logs.terminate()
+        subprocess.run(['docker', 'rm', '--force', container_name], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def get_python_version(image_name: str) -> str:
+    result = subprocess.run(['docker', 'run', '--rm', '--entrypoint', 'python3', image_name, '-c', 'import sys; print("%d.%d" % sys.version_info[:2])'],
+                            stdout=subprocess.PIPE, text=True, check=True)
+    return result.stdout.strip()
+
+
+def check_slim_image(image_name: str, module_name: str, benchmark_path: str) -> None:
+    logger = logging.getLogger()
+
+    # the server and the app must still handle real MRD sessions with only the collected files :
+    # config, JSON config text, XML header, images, for the app config and `invertcontrast`
+    logger.info(f'smoke test of the slim image `{image_name}`')
+    result = run_benchmark(image_name, module_name, benchmark_path, ['--session'])
+    logger.info(f"sessions served by server.Server.handle() : {result['sessions']}")
+
+    # the real CMD : main.py must start, listen on its port and serve the same sessions
+    container_name = f'{image_name}-smoke'.replace(':', '-')
+    subprocess.run(['docker', 'rm', '--force', container_name], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    subprocess.run(['docker', 'run', '--detach', '--network', 'none', '--name', container_name,
+                    '--volume', f'{benchmark_path}:/opt/bench/benchmark.py:ro', image_name], stdout=subprocess.DEVNULL, check=True)
+    try:
+        listening = False
+        deadline  = time.time() + 30
+        while (not listening) and (time.time() < deadline):
+            time.sleep(1)
+            result = subprocess.run(['docker', 'exec', container_name, 'python3', '-c', 'import socket; socket.create_connection(("127.0.0.1", 9002), timeout=1)'],
+                                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            listening = result.returncode == 0
+        if not listening:
+            subprocess.run(['docker', 'logs', container_name])
+            logger.critical('main.py does not listen on port 9002 in the slim image, see log above')
+            sys.exit(1)
+        result = subprocess.run(['docker', 'exec', '--workdir', '/opt/code/python-ismrmrd-server', container_name,
+                                 'python3', '/opt/bench/benchmark.py', f'--module={module_name}', '--server-dir=/opt/code/python-ismrmrd-server',
+                                 '--session', '--address=127.0.0.1:9002'], stdout=subprocess.PIPE, text=True)
+        if result.returncode != 0:
+            subprocess.run(['docker', 'logs', container_name])
+            logger.critical('main.py did not serve the MRD sessions in the slim image, see log above')
+            sys.exit(1)
+        logger.info(f"sessions served by main.py : {json.loads(result.stdout.strip().splitlines()[-1])['sessions']}")
+    finally:
+        subprocess.run(['docker', 'rm', '--force', container_name], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    logger.info('slim image is ok')
+
+
+def report_build_stats(stats_path: str, stats: dict) -> None:
+    logger = logging.getLogger()
+
+    for key, value in stats.items():
+        logger.info(f'{key:>12} : {value}')
+
+    # one line per build, to follow size and export time across versions
+    with open(stats_path, 'a') as fid:
+        fid.write(json.dumps(stats) + '\n')
+    logger.info(f'build stats appended to {stats_path}')
+
+
 def create_pdf(file_path: str, lines_of_text: list[str]) -> None:
     pdf_header = b'%PDF-1.4\n'
     
@@ -223,7 +392,8 @@ def main(args: argparse.Namespace):
 
     # check if all system programs are here
     print_section('SYSTEM DEPENDENCIES')
-    check_zip()
+    if not args.dev:
+        check_zip()
     check_git()
     check_docker()
 
@@ -239,6 +409,18 @@ def main(args: argparse.Namespace):
     print_section(f'Check "target" dir and its content : {target_path}')
     target_data = check_target_dir(target_path)
 
+    # dev mode : run the app from its dir, skip all build steps
+    if args.dev:
+        print_section('DEV SERVER')
+        run_dev_server(
+            target_data = target_data,
+            target_path = target_path,
+            debug_path  = os.path.join(cwd, 'build', 'debug'),
+            port        = args.dev_port,
+        )
+        print_section('All done !')
+        sys.exit(0)
+
     #############
     ### build ###
     #############
@@ -313,25 +495,59 @@ def main(args: argparse.Namespace):
                 logger.error(error)
         sys.exit(1)
     logger.info(f'No error in out JSON compared against the Schema')
+    cpu_cores = json_content['reconstruction'].get('min_count_required_cpu_cores', 1)
 
     # write the updated json in the `build` dir
     encoded_json_content = base64.b64encode((json.dumps(obj=json_content,indent=2)).encode('utf-8')).decode('utf-8')
     
+    # slim image : same python as the full image
+    if args.slim:
+        python_version = get_python_version('python-ismrmrd-server')
+        logger.info(f'slim image will be based on `python:{python_version}-slim`')
+
     # write the Dockerfile content
     logger.info(f"Write `build` Dockerfile : {build_data['path']['docker']}")
     with open(file=build_data['path']['docker'], mode='w') as fid:
-        fid.writelines([
-            '# import python-ismrmrd-server as starting point \n',
-            f'FROM python-ismrmrd-server \n',
-            '\n'])
+        if args.slim:
+            fid.writelines([
+                '# full python-ismrmrd-server : collect only what the app imports at runtime \n',
+                f'FROM python-ismrmrd-server AS full \n',
+                'COPY benchmark.py runtime_deps.py  /opt/slim/ \n',
+                f"COPY {os.path.relpath(target_data['path']['process'], cwd)} {os.path.relpath(target_data['path']['ui_json'], cwd)}  /opt/code/python-ismrmrd-server/ \n",
+                f'RUN python3 /opt/slim/runtime_deps.py --module={defaultConfig} --server-dir=/opt/code/python-ismrmrd-server --output=/opt/runtime \n',
+                '\n'])
+            fid.writelines([
+                '# minimal runtime : dependencies and server first, they change less often than the app \n',
+                f'FROM python:{python_version}-slim \n',
+                f'COPY --from=full /opt/runtime/site-packages  /usr/local/lib/python{python_version}/site-packages \n',
+                f'RUN python3 -m compileall -q /usr/local/lib/python{python_version}/site-packages \n',
+                'COPY --from=full /opt/runtime/server  /opt/code/python-ismrmrd-server \n',
+                'RUN python3 -m compileall -q /opt/code/python-ismrmrd-server \n',
+                '# bytecode is compiled at build time, nothing to write at runtime \n',
+                'ENV PYTHONDONTWRITEBYTECODE=1 \n',
+                '\n'])
+        else:
+            fid.writelines([
+                '# import python-ismrmrd-server as starting point \n',
+                f'FROM python-ismrmrd-server \n',
+                '\n'])
         fid.writelines([
             '# mandatory for OpenRecon (see OR documentation) \n',
             f'LABEL "com.siemens-healthineers.magneticresonance.openrecon.metadata:1.1.0"="{encoded_json_content}" \n',
             '\n'])
         fid.writelines([
-            '# copy the .py module \n',
+            '# copy the JSON UI, read at runtime to size threads and concurrent connections \n',
+            f"COPY {os.path.relpath(target_data['path']['ui_json'], cwd)}  /opt/code/python-ismrmrd-server \n",
+            f'ENV OMP_NUM_THREADS={cpu_cores} OPENBLAS_NUM_THREADS={cpu_cores} MKL_NUM_THREADS={cpu_cores} NUMEXPR_NUM_THREADS={cpu_cores} \n',
+            '\n'])
+        fid.writelines([
+            '# copy the .py module : last layer, so a code-only change only rebuilds this one \n',
             f"COPY {os.path.relpath(target_data['path']['process'], cwd)}  /opt/code/python-ismrmrd-server \n",
             '\n'])
+        if args.slim:
+            fid.writelines([
+                f"RUN python3 -m compileall -q /opt/code/python-ismrmrd-server/{os.path.basename(target_data['path']['process'])} \n",
+                '\n'])
         fid.writelines([
             '# new CMD line \n',
             f'{cmdline} \n',
@@ -341,9 +557,30 @@ def main(args: argparse.Namespace):
     logger.info(f"building docker image `{build_data['name']['docker']}` from Docker file {build_data['path']['docker']}")
     subprocess.run(['docker', 'build', '--tag', build_data['name']['docker'], '--file', build_data['path']['docker'], cwd], check=True)
 
+    if args.slim:
+        check_slim_image(
+            image_name     = build_data['name']['docker'],
+            module_name    = target_data['name']['process'],
+            benchmark_path = os.path.join(cwd, 'benchmark.py'),
+        )
+
+    # performance gate, before the slow save/zip steps
+    if args.perf_gate or args.perf_update_baseline:
+        print_section('PERFORMANCE')
+        check_performance(
+            image_name      = build_data['name']['docker'],
+            module_name     = target_data['name']['process'],
+            benchmark_path  = os.path.join(cwd, 'benchmark.py'),
+            baseline_path   = os.path.join(target_path, f"{target_data['name']['process']}_perf_baseline.json"),
+            tolerance       = args.perf_tolerance,
+            update_baseline = args.perf_update_baseline,
+        )
+
     # save docker image in a .tar
     logger.info(f"(1/2) saving image `{build_data['name']['docker']}` in a .tar {build_data['path']['tar']}")
+    start = time.perf_counter()
     subprocess.run(['docker', 'save', '-o', build_data['path']['tar'], build_data['name']['docker']], check=True)
+    save_s = time.perf_counter() - start
     logger.info(f'(2/2) saving image DONE')
 
     # generate PDF
@@ -357,9 +594,28 @@ def main(args: argparse.Namespace):
 
     # save everything in a ZIP file
     logger.info(f"(1/2) zip all files : {build_data['path']['zip']}")
+    start = time.perf_counter()
     subprocess.run(['zip', build_data['name']['base']+'.zip', build_data['name']['base']+'.tar', build_data['name']['base']+'.pdf'], check=True, cwd=build_path)
+    zip_s = time.perf_counter() - start
     logger.info(f'(1/2) zip all files DONE')
 
+    # size & time, to track the gains of `--slim`
+    print_section('BUILD STATS')
+    result = subprocess.run(['docker', 'image', 'inspect', '--format', '{{.Size}}', build_data['name']['docker']], stdout=subprocess.PIPE, text=True, check=True)
+    report_build_stats(
+        stats_path = os.path.join(build_path, 'build_stats.jsonl'),
+        stats      = {
+            'date'    : datetime.datetime.now().isoformat(timespec='seconds'),
+            'image'   : build_data['name']['docker'],
+            'slim'    : args.slim,
+            'image_mb': round(int(result.stdout.strip()) / 2**20, 1),
+            'tar_mb'  : round(os.path.getsize(build_data['path']['tar']) / 2**20, 1),
+            'zip_mb'  : round(os.path.getsize(build_data['path']['zip']) / 2**20, 1),
+            'save_s'  : round(save_s, 1),
+            'zip_s'   : round(zip_s, 1),
+        },
+    )
+
     # END
     print_section('All done !')
     sys.exit(0)
@@ -384,6 +640,38 @@ if __name__ == '__main__':
         help    = 'Application directory name. ex: `demo-i2i`, `app`',
         default = 'demo-i2i'
     )
+    parser.add_argument(
+        '--slim',
+        action  = 'store_true',
+        help    = 'Build a minimal runtime image, with only the packages the app imports at runtime',
+    )
+    parser.add_argument(
+        '--dev',
+        action  = 'store_true',
+        help    = 'Run the `python-ismrmrd-server` image with the app dir mounted, restart it when the app changes. No build.',
+    )
+    parser.add_argument(
+        '--dev-port',
+        type    = int,
+        help    = 'Host port of the dev server',
+        default = 9002
+    )
+    parser.add_argument(
+        '--perf-gate',
+        action  = 'store_true',
+        help    = 'Run `benchmark.py` in the built image and fail if slower than `<dirname>/<process>_perf_baseline.json`',
+    )
+    parser.add_argument(
+        '--perf-tolerance',
+        type    = float,
+        help    = 'Allowed relative regression of images/s and peak memory vs. the baseline',
+        default = 0.10
+    )
+    parser.add_argument(
+        '--perf-update-baseline',
+        action  = 'store_true',
+        help    = 'Run `benchmark.py` in the built image and (over)write the baseline file with the result',
+    )
 
     args = parser.parse_args()
 
@@ -0,0 +1,142 @@
+# intenend for python3
+
+# Collect the files an OpenRecon app needs at runtime, to build a minimal image.
+# Run by `build.py --slim` in the first stage of the Dockerfile, inside the full `python-ismrmrd-server` image.
+
+# builtin modules
+import argparse
+import importlib
+import importlib.metadata
+import logging
+import os
+import re
+import shutil
+import sys
+
+
+# Imported by the server before any app module
+SERVER_MODULES = ['server', 'connection', 'constants', 'mrdhelper']
+
+# Not needed at runtime
+SKIP_DIRS       = ['__pycache__', 'tests', 'test']
+SKIP_EXTENSIONS = ['.pyc', '.pyo', '.pyi']
+
+SITE_PATTERN = re.compile(r'^(.*[/\\](?:site|dist)-packages)[/\\]([^/\\]+)')
+
+
+def import_runtime(module_name: str, server_dir: str) -> None:
+    logger = logging.getLogger()
+
+    sys.path.insert(0, server_dir)
+    for name in SERVER_MODULES + [module_name]:
+        logger.info(f'import {name}')
+        importlib.import_module(name)
+
+    # real MRD sessions served by server.Server.handle(), to also catch the imports done lazily
+    # by the server (config, XML header parsing...) and during processing
+    import benchmark
+    for name, received in benchmark.run_sessions(module_name).items():
+        logger.info(f'session `{name}` : {received} images sent back')
+
+
+def find_loaded() -> tuple[set, set, set]:
+    # distributions, top-level paths without distribution, and files of all loaded modules
+    packages = importlib.metadata.packages_distributions()
+    dists    = set()
+    orphans  = set()
+    loaded   = set()
+    for name, module in list(sys.modules.items()):
+        path = getattr(module, '__file__', None)
+        if path is None:
+            continue
+        path = os.path.realpath(path)
+        loaded.add(path)
+        match = SITE_PATTERN.match(path)
+        if match is None:
+            continue # stdlib, or server dir
+        top = name.split('.')[0]
+        if top in packages:
+            dists.update(packages[top])
+        else:
+            orphans.add(os.path.join(match.group(1), match.group(2)))
+    return dists, orphans, loaded
+
+
+def keep(rel_path: str, src: str, loaded: set) -> bool:
+    if os.path.splitext(rel_path)[1] in SKIP_EXTENSIONS:
+        return False
+    parts = rel_path.replace('\\', '/').split('/')
+    if any(part in SKIP_DIRS for part in parts[:-1]):
+        return os.path.realpath(src) in loaded
+    return True
+
+
+def copy_file(src: str, dst: str) -> int:
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    shutil.copy2(src, dst)
+    return os.path.getsize(dst)
+
+
+def main(args: argparse.Namespace):
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format=f"%(levelname)8s:%(funcName)15s: %(message)s",
+    )
+    logger = logging.getLogger()
+
+    import_runtime(args.module, args.server_dir)
+    dists, orphans, loaded = find_loaded()
+
+    site_output = os.path.join(args.output, 'site-packages')
+    total = 0
+    for dist_name in sorted(dists):
+        dist = importlib.metadata.distribution(dist_name)
+        size = 0
+        for file in dist.files or []:
+            if str(file).startswith('..'):
+                continue # scripts, headers... outside site-packages
+            src = str(dist.locate_file(file))
+            if os.path.isfile(src) and keep(str(file), src, loaded):
+                size += copy_file(src, os.path.join(site_output, str(file)))
+        logger.info(f'keep distribution {dist_name} : {size/2**20:.1f} MB')
+        total += size
+
+    for orphan in sorted(orphans):
+        size = 0
+        if os.path.isfile(orphan):
+            size += copy_file(orphan, os.path.join(site_output, os.path.basename(orphan)))
+        else:
+            for root, _, files in os.walk(orphan):
+                for file in files:
+                    src = os.path.join(root, file)
+                    rel = os.path.relpath(src, os.path.dirname(orphan))
+                    if keep(rel, src, loaded):
+                        size += copy_file(src, os.path.join(site_output, rel))
+        logger.info(f'keep {orphan} (no distribution) : {size/2**20:.1f} MB')
+        total += size
+
+    # server code : top-level .py files only, the app module is copied in its own layer
+    server_output = os.path.join(args.output, 'server')
+    for file in sorted(os.listdir(args.server_dir)):
+        src = os.path.join(args.server_dir, file)
+        if file.endswith('.py') and os.path.isfile(src) and file != f'{args.module}.py':
+            total += copy_file(src, os.path.join(server_output, file))
+
+    logger.info(f'runtime files : {total/2**20:.1f} MB in {args.output}')
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        prog            = 'runtime_deps',
+        description     = 'Copy the packages an OpenRecon app module imports at runtime',
+        formatter_class = argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument('--module'    , required=True, help='Name of the .py process module, ex: `i2i-save-original-images`')
+    parser.add_argument('--server-dir', default='/opt/code/python-ismrmrd-server', help='Directory containing the server and the module')
+    parser.add_argument('--output'    , default='/opt/runtime', help='Output dir : `site-packages` and `server` subdirs')
+
+    args = parser.parse_args()
+
+    main(args)